@@ -1,13 +1,419 @@
 """
-RunPod Serverless Handler for NVIDIA-SMI GPU Information
+RunPod Serverless Handler for GPU Information (via NVML, nvidia-smi fallback)
 Following RunPod official documentation patterns
 """
 
 import runpod
+import pynvml
 import subprocess
-import json
+import threading
+import atexit
+import collections
+import csv
+import functools
+import logging
 import os
-from pathlib import Path
+import time
+
+
+# Per-request logs are DEBUG; set LOG_LEVEL=DEBUG to see them. Disabled
+# levels short-circuit before any message formatting happens.
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").upper()
+# getLevelName maps known level names to ints (getLevelNamesMapping needs 3.11)
+_LOG_LEVEL_VALID = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(
+    level=LOG_LEVEL if _LOG_LEVEL_VALID else logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+if not _LOG_LEVEL_VALID:
+    logger.warning("Unknown LOG_LEVEL '%s', falling back to INFO", LOG_LEVEL)
+
+
+# Telemetry doesn't change meaningfully within a second, so bursts of jobs
+# share one NVML read per interval
+try:
+    GPU_POLL_INTERVAL_SECONDS = float(os.getenv("GPU_POLL_INTERVAL_SECONDS") or "1")
+    if not GPU_POLL_INTERVAL_SECONDS >= 0:
+        raise ValueError(f"{GPU_POLL_INTERVAL_SECONDS} is not a non-negative number")
+except ValueError as e:
+    logger.warning("Invalid GPU_POLL_INTERVAL_SECONDS (%s), falling back to 1", e)
+    GPU_POLL_INTERVAL_SECONDS = 1.0
+
+# Fields streamed by the nvidia-smi loop used when NVML can't be loaded
+NVIDIA_SMI_QUERY = "index,name,driver_version,memory.total,memory.used,memory.free,temperature.gpu,power.draw"
+NVIDIA_SMI_LOOP_MS = 500
+NVIDIA_SMI_START_TIMEOUT_SECONDS = 5
+
+# How long to wait before probing for GPUs again after GPU initialization
+# failed or the nvidia-smi loop exited
+GPU_RETRY_SECONDS = 3600
+
+# Per-GPU fields and the column each is returned under in gpu_details
+GPU_DETAIL_COLUMNS = {
+    "gpu_id": "gpu_ids",
+    "name": "names",
+    "driver_version": "driver_versions",
+    "memory_total_mb": "memory_total_mb",
+    "memory_used_mb": "memory_used_mb",
+    "memory_free_mb": "memory_free_mb",
+    "temperature_c": "temperature_c",
+    "power_draw_w": "power_draw_w"
+}
+
+
+def ttl_cache(ttl):
+    """
+    Cache the result of a zero-argument function for ttl seconds
+    """
+    def decorator(func):
+        cache = {"timestamp": None, "value": None}
+
+        @functools.wraps(func)
+        def wrapper():
+            now = time.monotonic()
+            if cache["timestamp"] is not None and now - cache["timestamp"] < ttl:
+                return cache["value"]
+            cache["value"] = func()
+            cache["timestamp"] = now
+            return cache["value"]
+
+        return wrapper
+    return decorator
+
+
+def parse_smi_value(value):
+    """
+    Convert a nounits nvidia-smi CSV value to a number when possible.
+    Unsupported readings become None, matching the NVML path.
+    """
+    if value in ("[N/A]", "[Not Supported]"):
+        return None
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def drain_nvidia_smi(process, first_block):
+    """
+    Keep the latest nvidia-smi loop sample for each GPU. Lines that aren't
+    samples (e.g. driver errors) are kept for error reporting.
+    """
+    try:
+        for parts in csv.reader(process.stdout, skipinitialspace=True):
+            if len(parts) < 8:
+                _SMI_OUTPUT.append(", ".join(parts))
+                continue
+            try:
+                gpu_id = int(parts[0])
+            except ValueError:
+                # Skip unexpected lines rather than killing the drain thread
+                _SMI_OUTPUT.append(", ".join(parts))
+                continue
+            if gpu_id in _SMI_SAMPLES:
+                # A GPU reporting again means the first block is complete
+                first_block.set()
+            _SMI_SAMPLES[gpu_id] = {
+                "gpu_id": gpu_id,
+                "name": parts[1],
+                "driver_version": parts[2],
+                "memory_total_mb": parse_smi_value(parts[3]),
+                "memory_used_mb": parse_smi_value(parts[4]),
+                "memory_free_mb": parse_smi_value(parts[5]),
+                "temperature_c": parse_smi_value(parts[6]),
+                "power_draw_w": parse_smi_value(parts[7])
+            }
+    finally:
+        # Reap the process so poll() reports its exit code as soon as the
+        # pipe closes, then unblock anyone still waiting for a first block
+        process.wait()
+        first_block.set()
+
+
+def start_nvidia_smi_loop():
+    """
+    Start one long-lived nvidia-smi in loop mode and drain it in the background
+    """
+    _SMI_SAMPLES.clear()
+    _SMI_OUTPUT.clear()
+    try:
+        process = subprocess.Popen([
+            'nvidia-smi',
+            f'--query-gpu={NVIDIA_SMI_QUERY}',
+            '--format=csv,noheader,nounits',
+            '-lms', str(NVIDIA_SMI_LOOP_MS)
+        ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError as e:
+        logger.warning("nvidia-smi unavailable: %s", e)
+        return None
+    
+    first_block = threading.Event()
+    threading.Thread(target=drain_nvidia_smi, args=(process, first_block), daemon=True).start()
+    
+    # Wait for a complete block of samples (or an early exit) so the first
+    # job doesn't see an empty or partial GPU list
+    first_block.wait(NVIDIA_SMI_START_TIMEOUT_SECONDS)
+    return process
+
+
+def nvidia_smi_error():
+    """
+    Return an error if the nvidia-smi loop has exited, else None
+    """
+    returncode = _SMI_PROCESS.poll()
+    if returncode is None:
+        return None
+    if returncode == 0:
+        return RuntimeError("nvidia-smi loop exited")
+    return subprocess.CalledProcessError(
+        returncode, 'nvidia-smi', output="\n".join(_SMI_OUTPUT)
+    )
+
+
+def mark_gpu_init_failed(error):
+    """
+    Record a GPU initialization failure and back off re-probing for
+    GPU_RETRY_SECONDS; requests report the error until then
+    
+    Returns:
+        bool: Always False, for use as init_gpu_sources()'s result
+    """
+    global HAS_GPU, _GPU_RETRY_AT, _GPU_INIT_ERROR
+    
+    logger.warning("GPU initialization failed, retrying in %ds: %s", GPU_RETRY_SECONDS, error)
+    HAS_GPU = False
+    _GPU_RETRY_AT = time.monotonic() + GPU_RETRY_SECONDS
+    _GPU_INIT_ERROR = error
+    return False
+
+
+def cuda_devices_hidden():
+    """
+    Return whether CUDA_VISIBLE_DEVICES is set but empty, i.e. no GPUs assigned
+    """
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    return visible_devices is not None and not visible_devices.strip()
+
+
+def init_gpu_sources():
+    """
+    Initialize NVML once per worker and cache device handles so each request
+    queries the driver in-process instead of forking nvidia-smi. If NVML can't
+    be loaded, stream from a single nvidia-smi loop instead of forking per job.
+    
+    Returns:
+        bool: Whether there are GPUs to poll
+    """
+    global NVML_AVAILABLE, _GPU_HANDLES, _STATIC_GPU_INFO, _CUDA_INFO, _SMI_PROCESS, _GPU_RETRY_AT, _GPU_INIT_ERROR
+    
+    # Keep reporting the previous failure until a re-probe succeeds
+    _GPU_RETRY_AT = None
+    if cuda_devices_hidden():
+        logger.info("CUDA_VISIBLE_DEVICES is empty, GPU polling disabled")
+        _GPU_INIT_ERROR = None
+        return False
+    
+    try:
+        pynvml.nvmlInit()
+        NVML_AVAILABLE = True
+    except pynvml.NVMLError as e:
+        logger.warning("NVML unavailable (%s), falling back to nvidia-smi loop mode", e)
+        NVML_AVAILABLE = False
+    
+    if not NVML_AVAILABLE:
+        _SMI_PROCESS = start_nvidia_smi_loop()
+        if _SMI_PROCESS is None:
+            return mark_gpu_init_failed(RuntimeError("Neither NVML nor nvidia-smi is available"))
+        
+        error = nvidia_smi_error()
+        if error is not None:
+            return mark_gpu_init_failed(error)
+        _GPU_INIT_ERROR = None
+        return True
+    
+    try:
+        handles = [
+            pynvml.nvmlDeviceGetHandleByIndex(i)
+            for i in range(pynvml.nvmlDeviceGetCount())
+        ]
+
+        # Driver version, GPU names and total memory never change while the
+        # worker is alive, so read them once instead of on every request
+        driver_version = pynvml.nvmlSystemGetDriverVersion()
+        static_gpu_info = [
+            {
+                "gpu_id": i,
+                "name": pynvml.nvmlDeviceGetName(handle),
+                "driver_version": driver_version,
+                "memory_total_mb": pynvml.nvmlDeviceGetMemoryInfo(handle).total // (1024 * 1024),
+            }
+            for i, handle in enumerate(handles)
+        ]
+        cuda_driver_version = pynvml.nvmlSystemGetCudaDriverVersion()
+    except pynvml.NVMLError as e:
+        NVML_AVAILABLE = False
+        try:
+            pynvml.nvmlShutdown()
+        except pynvml.NVMLError:
+            pass
+        return mark_gpu_init_failed(e)
+    
+    _GPU_HANDLES = handles
+    _STATIC_GPU_INFO = static_gpu_info
+    _CUDA_INFO = f"CUDA {cuda_driver_version // 1000}.{(cuda_driver_version % 1000) // 10} (driver)"
+    _GPU_INIT_ERROR = None
+    return len(_GPU_HANDLES) > 0
+
+
+def reprobe_gpu_sources():
+    """
+    Retry GPU initialization after a failure
+    """
+    global HAS_GPU
+    
+    HAS_GPU = init_gpu_sources()
+
+
+def gpu_available():
+    """
+    Return whether GPUs can be polled, re-probing a failed initialization at
+    most once every GPU_RETRY_SECONDS. The re-probe runs in the background so
+    no job waits on NVML init or the nvidia-smi start-up timeout; jobs keep
+    reporting the last error until it succeeds.
+    """
+    global _GPU_RETRY_AT
+    
+    with _GPU_RETRY_LOCK:
+        retry_due = not HAS_GPU and _GPU_RETRY_AT is not None and time.monotonic() >= _GPU_RETRY_AT
+        if retry_due:
+            _GPU_RETRY_AT = None
+    
+    if retry_due:
+        threading.Thread(target=reprobe_gpu_sources, daemon=True).start()
+    return HAS_GPU
+
+
+def shutdown_gpu_sources():
+    """
+    Stop the nvidia-smi loop and release NVML when the worker exits
+    """
+    if _SMI_PROCESS is not None and _SMI_PROCESS.poll() is None:
+        _SMI_PROCESS.terminate()
+    if NVML_AVAILABLE:
+        try:
+            pynvml.nvmlShutdown()
+        except pynvml.NVMLError:
+            pass
+
+
+NVML_AVAILABLE = False
+_GPU_HANDLES = []
+_STATIC_GPU_INFO = []
+_CUDA_INFO = "Not available"
+_SMI_SAMPLES = {}
+_SMI_OUTPUT = collections.deque(maxlen=20)
+_SMI_PROCESS = None
+_GPU_RETRY_AT = None
+_GPU_RETRY_LOCK = threading.Lock()
+_GPU_INIT_ERROR = None
+atexit.register(shutdown_gpu_sources)
+HAS_GPU = init_gpu_sources()
+
+
+def read_nvml_field(read, *args):
+    """
+    Call an NVML getter, returning None when the GPU doesn't support the
+    reading (e.g. power draw on MIG instances) so other fields still report
+    """
+    try:
+        return read(*args)
+    except pynvml.NVMLError_NotSupported:
+        return None
+
+
+@ttl_cache(GPU_POLL_INTERVAL_SECONDS)
+def read_dynamic_gpu_info():
+    """
+    Query per-GPU memory usage, temperature and power draw via NVML
+    """
+    dynamic_info = []
+    for handle in _GPU_HANDLES:
+        memory = read_nvml_field(pynvml.nvmlDeviceGetMemoryInfo, handle)
+        power_mw = read_nvml_field(pynvml.nvmlDeviceGetPowerUsage, handle)
+        dynamic_info.append({
+            "memory_used_mb": memory.used // (1024 * 1024) if memory is not None else None,
+            "memory_free_mb": memory.free // (1024 * 1024) if memory is not None else None,
+            "temperature_c": read_nvml_field(pynvml.nvmlDeviceGetTemperature, handle, pynvml.NVML_TEMPERATURE_GPU),
+            "power_draw_w": power_mw / 1000 if power_mw is not None else None
+        })
+    return dynamic_info
+
+
+def read_gpu_details():
+    """
+    Return per-GPU details from NVML, or from the nvidia-smi loop when NVML is unavailable
+    """
+    # Read the error first; a background re-probe may clear it concurrently
+    init_error = _GPU_INIT_ERROR
+    if not gpu_available():
+        if init_error is not None:
+            raise init_error.with_traceback(None)
+        return []
+    
+    if NVML_AVAILABLE:
+        return [
+            {**static, **dynamic}
+            for static, dynamic in zip(_STATIC_GPU_INFO, read_dynamic_gpu_info())
+        ]
+    
+    # Don't serve stale samples once the loop has died
+    error = nvidia_smi_error()
+    if error is not None:
+        mark_gpu_init_failed(error)
+        raise error
+    
+    # Snapshot first; the drain thread may add GPUs while we iterate
+    samples = dict(_SMI_SAMPLES)
+    if not samples:
+        raise RuntimeError("No nvidia-smi sample received yet")
+    
+    return [samples[gpu_id] for gpu_id in sorted(samples)]
+
+
+def to_columns(gpu_details):
+    """
+    Convert per-GPU detail dicts into one list per field, so multi-GPU
+    responses don't repeat every key for each GPU
+    """
+    return {
+        column: [gpu[field] for gpu in gpu_details]
+        for field, column in GPU_DETAIL_COLUMNS.items()
+    }
+
+
+def enable_persistence_mode():
+    """
+    Keep the NVIDIA driver loaded between jobs so idle GPUs don't pay driver
+    re-initialization on the next query. Requires root; failures are logged.
+    """
+    if not HAS_GPU:
+        return
+    
+    if NVML_AVAILABLE:
+        for i, handle in enumerate(_GPU_HANDLES):
+            try:
+                pynvml.nvmlDeviceSetPersistenceMode(handle, pynvml.NVML_FEATURE_ENABLED)
+            except pynvml.NVMLError as e:
+                logger.warning("Could not enable persistence mode on GPU %d: %s", i, e)
+        return
+    
+    try:
+        subprocess.run(['nvidia-smi', '-pm', '1'], check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Could not enable persistence mode: %s", e)
 
 
 def list_workspace_files(path="/workspace"):
@@ -15,9 +421,7 @@ def list_workspace_files(path="/workspace"):
     List files and directories in the specified path
     """
     try:
-        path_obj = Path(path)
-        
-        if not path_obj.exists():
+        if not os.path.exists(path):
             return {
                 "status": "error",
                 "error": f"Path does not exist: {path}"
@@ -26,21 +430,23 @@ def list_workspace_files(path="/workspace"):
         files = []
         directories = []
         
-        # List all items in the directory
-        for item in path_obj.iterdir():
-            if item.is_file():
-                files.append({
-                    "name": item.name,
-                    "path": str(item),
-                    "size": item.stat().st_size,
-                    "type": "file"
-                })
-            elif item.is_dir():
-                directories.append({
-                    "name": item.name,
-                    "path": str(item),
-                    "type": "directory"
-                })
+        # List all items in the directory; DirEntry type checks use the
+        # dirent type bits and cache stat() results, avoiding per-entry stats
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files.append({
+                        "name": entry.name,
+                        "path": entry.path,
+                        "size": entry.stat().st_size,
+                        "type": "file"
+                    })
+                elif entry.is_dir():
+                    directories.append({
+                        "name": entry.name,
+                        "path": entry.path,
+                        "type": "directory"
+                    })
         
         # Sort for consistent output
         files.sort(key=lambda x: x["name"])
@@ -48,7 +454,7 @@ def list_workspace_files(path="/workspace"):
         
         return {
             "status": "success",
-            "path": str(path_obj.absolute()),
+            "path": os.path.abspath(path),
             "directories": directories,
             "files": files,
             "total_files": len(files),
@@ -73,11 +479,10 @@ def handler(job):
         dict: Result containing GPU information or error
     """
     try:
-        # Get input data (optional for nvidia-smi)
+        # Get input data (optional for GPU info)
         job_input = job.get("input", {})
-        print(f"DEBUG: Received job_input: {job_input}")
-        print(f"DEBUG: Action value: '{job_input.get('action')}'")
-        print(f"DEBUG: Action type: {type(job_input.get('action'))}")
+        logger.debug("Received job_input: %s", job_input)
+        logger.debug("Action value: '%s' (type %s)", job_input.get("action"), type(job_input.get("action")))
         
         # Model downloading removed - handle via S3 manually
         if job_input.get("action") == "download_models":
@@ -88,7 +493,7 @@ def handler(job):
         
         # Check if this is a file listing request
         if job_input.get("action") == "list_files":
-            print("Processing file listing request...")
+            logger.debug("Processing file listing request...")
             return list_workspace_files(job_input.get("path", "/workspace"))
         
         # If action is specified but not recognized, return error
@@ -104,57 +509,15 @@ def handler(job):
                 }
             }
         
-        # Run nvidia-smi command to get GPU information (only when no action specified)
-        print("Running nvidia-smi...")
+        # Query GPU information (only when no action specified)
+        logger.debug("Querying GPU information...")
         
-        # Basic nvidia-smi output
-        smi_result = subprocess.check_output(
-            ['nvidia-smi'], 
-            text=True, 
-            stderr=subprocess.STDOUT
-        )
-        
-        # Get additional GPU details
-        gpu_query_result = subprocess.check_output([
-            'nvidia-smi', 
-            '--query-gpu=name,driver_version,memory.total,memory.used,memory.free,temperature.gpu,power.draw',
-            '--format=csv,noheader,nounits'
-        ], text=True, stderr=subprocess.STDOUT)
-        
-        # Parse GPU details
-        gpu_lines = gpu_query_result.strip().split('\n')
-        gpu_details = []
-        for i, line in enumerate(gpu_lines):
-            parts = [part.strip() for part in line.split(',')]
-            if len(parts) >= 7:
-                gpu_details.append({
-                    "gpu_id": i,
-                    "name": parts[0],
-                    "driver_version": parts[1],
-                    "memory_total_mb": parts[2],
-                    "memory_used_mb": parts[3], 
-                    "memory_free_mb": parts[4],
-                    "temperature_c": parts[5],
-                    "power_draw_w": parts[6]
-                })
-        
-        # Get CUDA information if available
-        cuda_version = "Not available"
-        try:
-            cuda_result = subprocess.check_output(['nvcc', '--version'], text=True, stderr=subprocess.STDOUT)
-            # Extract CUDA version from nvcc output
-            for line in cuda_result.split('\n'):
-                if 'release' in line.lower():
-                    cuda_version = line.strip()
-                    break
-        except:
-            cuda_version = "NVCC not available"
+        gpu_details = read_gpu_details()
         
         return {
             "status": "success",
-            "nvidia_smi_output": smi_result,
-            "gpu_details": gpu_details,
-            "cuda_info": cuda_version,
+            "gpu_details": to_columns(gpu_details),
+            "cuda_info": _CUDA_INFO,
             "gpu_count": len(gpu_details),
             "environment": {
                 "cuda_visible_devices": os.getenv("CUDA_VISIBLE_DEVICES", "Not set"),
@@ -170,6 +533,12 @@ def handler(job):
             "error": f"Command failed: {str(e)}",
             "output": e.output if hasattr(e, 'output') else "No output"
         }
+    except pynvml.NVMLError as e:
+        return {
+            "status": "error",
+            "error_type": "nvml_error",
+            "error": f"NVML query failed: {str(e)}"
+        }
     except Exception as e:
         return {
             "status": "error", 
@@ -180,6 +549,7 @@ def handler(job):
 
 
 if __name__ == "__main__":
-    print("Starting RunPod Serverless Handler...")
-    print("Handler ready to process nvidia-smi requests")
+    logger.info("Starting RunPod Serverless Handler...")
+    enable_persistence_mode()
+    logger.info("Handler ready to process GPU info requests")
     runpod.serverless.start({"handler": handler})
\ No newline at end of file